@@ -1,11 +1,17 @@
-import json
 import os
-import time
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _loads
+except ImportError:  # stdlib fallback, also accepts bytes
+    from json import loads as _loads
 
 # ======================
 # CONFIG
@@ -15,6 +21,7 @@ SHEET_NAME = "Sheet1"
 TIMEZONE = "Europe/Lisbon"
 
 FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+TIMEOUT_SECS = 15
 
 # FIXED, VERIFIED COORDINATES (MAINLAND PORTUGAL)
 CONCELHOS = {
@@ -44,90 +51,165 @@ HEADERS = [
 # ======================
 def get_sheets_service():
     creds = Credentials.from_service_account_info(
-        json.loads(os.environ["GOOGLE_CREDENTIALS"]),
+        _loads(os.environ["GOOGLE_CREDENTIALS"]),
         scopes=["https://www.googleapis.com/auth/spreadsheets"],
     )
-    return build("sheets", "v4", credentials=creds)
-
-
-def read_sheet(service):
-    res = service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=SHEET_NAME,
-    ).execute()
-    return res.get("values", [])
+    # use the discovery doc bundled with the client, no fetch at startup
+    return build("sheets", "v4", credentials=creds, static_discovery=True)
 
 
-def write_sheet(service, values):
-    service.spreadsheets().values().clear(
+def read_sheet_dates(service):
+    # one call returns the numeric id of SHEET_NAME (needed for row-level
+    # batchUpdate requests) and column A, which is all main() needs
+    res = service.spreadsheets().get(
         spreadsheetId=SPREADSHEET_ID,
-        range=SHEET_NAME,
+        ranges=[f"{SHEET_NAME}!A:A"],
+        fields=(
+            "sheets(properties(sheetId,title),"
+            "data.rowData.values.formattedValue)"
+        ),
     ).execute()
 
-    service.spreadsheets().values().update(
+    for sheet in res.get("sheets", []):
+        if sheet["properties"]["title"] == SHEET_NAME:
+            break
+    else:
+        raise ValueError(
+            f"sheet {SHEET_NAME!r} not found in spreadsheet {SPREADSHEET_ID}"
+        )
+
+    dates = []
+    for data in sheet.get("data", []):
+        for row in data.get("rowData", []):
+            cells = row.get("values") or [{}]
+            dates.append(cells[0].get("formattedValue", ""))
+    return sheet["properties"]["sheetId"], dates
+
+
+def _cell(value):
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": value}}
+
+
+def replace_rows(service, sheet_id, stale_ranges, rows):
+    # one round-trip: drop the stale row ranges (bottom-up so indices stay
+    # valid), then append after the last row with data, growing the grid
+    reqs = [
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "dimension": "ROWS",
+                    "startIndex": start,
+                    "endIndex": end,
+                }
+            }
+        }
+        for start, end in reversed(stale_ranges)
+    ]
+    reqs.append({
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [_cell(v) for v in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }
+    })
+
+    service.spreadsheets().batchUpdate(
         spreadsheetId=SPREADSHEET_ID,
-        range=SHEET_NAME,
-        valueInputOption="RAW",
-        body={"values": values},
+        body={"requests": reqs},
     ).execute()
 
 
 # ======================
 # WEATHER HELPERS
 # ======================
-def _fetch_json(url, retries=3):
-    req = urllib.request.Request(url, headers={"User-Agent": "ipma-weather/1.0"})
-    for i in range(retries):
-        try:
-            with urllib.request.urlopen(req, timeout=15) as r:
-                return json.load(r)
-        except Exception:
-            if i == retries - 1:
-                raise
-            time.sleep(2)
+# shared keep-alive session; retries with backoff happen inside the adapter,
+# covering rate limits and transient server errors (Retry-After is honoured)
+_SESSION = requests.Session()
+_SESSION.headers["User-Agent"] = "ipma-weather/1.0"
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+        ),
+    ),
+)
+
+
+def _fetch_json(url):
+    r = _SESSION.get(url, timeout=TIMEOUT_SECS)
+    r.raise_for_status()
+    return _loads(r.content)
+
+
+COMPASS_DIRS = (
+    "N","NNE","NE","ENE","E","ESE","SE","SSE",
+    "S","SSW","SW","WSW","W","WNW","NW","NNW",
+)
+
+
+# Open-Meteo reports whole degrees, so precompute the sector for each one
+_COMPASS_BY_DEGREE = tuple(
+    COMPASS_DIRS[int((d + 11.25) / 22.5) % 16] for d in range(360)
+)
 
 
 def _degrees_to_compass(deg):
-    dirs = [
-        "N","NNE","NE","ENE","E","ESE","SE","SSE",
-        "S","SSW","SW","WSW","W","WNW","NW","NNW",
-    ]
-    return dirs[int((deg + 11.25) / 22.5) % 16]
-
-
-def _forecast_today(lat, lon):
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "daily": "temperature_2m_max,temperature_2m_min",
-        "hourly": "windspeed_10m,winddirection_10m",
-        "forecast_days": 1,
-        "timezone": TIMEZONE,
-        "windspeed_unit": "kmh",
-    }
-    url = f"{FORECAST_URL}?{urllib.parse.urlencode(params)}"
+    return _COMPASS_BY_DEGREE[int(deg) % 360]
+
+
+# fixed part of the forecast query, encoded once; only coordinates vary
+_FORECAST_QUERY = urllib.parse.urlencode({
+    "daily": "temperature_2m_max,temperature_2m_min",
+    "hourly": "windspeed_10m,winddirection_10m",
+    "forecast_days": 1,
+    "timezone": TIMEZONE,
+    "windspeed_unit": "kmh",
+})
+
+
+# one request for all (lat, lon) pairs; results come back in the same order
+def _forecast_today(locations):
+    lats = ",".join(str(lat) for lat, _ in locations)
+    lons = ",".join(str(lon) for _, lon in locations)
+    url = f"{FORECAST_URL}?{_FORECAST_QUERY}&latitude={lats}&longitude={lons}"
     data = _fetch_json(url)
 
+    # a single location comes back as an object, several as a list
+    if isinstance(data, dict):
+        data = [data]
+    return [_summarize_forecast(d) for d in data]
+
+
+def _summarize_forecast(data):
     daily = data["daily"]
     hourly = data["hourly"]
 
     speeds = hourly["windspeed_10m"]
     directions = hourly["winddirection_10m"]
 
-    max_speed = max(speeds)
-    max_dirs = {
-        _degrees_to_compass(d)
-        for s, d in zip(speeds, directions)
-        if s == max_speed
-    }
-
-    unique_speeds = sorted(set(speeds), reverse=True)
-    second_speed = unique_speeds[1] if len(unique_speeds) > 1 else None
-    second_dirs = {
-        _degrees_to_compass(d)
-        for s, d in zip(speeds, directions)
-        if second_speed and s == second_speed
-    }
+    # single pass: track the top two speeds and the directions they occur in
+    max_speed = second_speed = -1.0
+    max_dirs, second_dirs = set(), set()
+    for s, d in zip(speeds, directions):
+        if s > max_speed:
+            second_speed, second_dirs = max_speed, max_dirs
+            max_speed, max_dirs = s, {_degrees_to_compass(d)}
+        elif s == max_speed:
+            max_dirs.add(_degrees_to_compass(d))
+        elif s > second_speed:
+            second_speed, second_dirs = s, {_degrees_to_compass(d)}
+        elif s == second_speed:
+            second_dirs.add(_degrees_to_compass(d))
+
+    if second_speed <= 0:
+        second_speed, second_dirs = None, set()
 
     return {
         "date": daily["time"][0],
@@ -143,18 +225,41 @@ def _forecast_today(lat, lon):
 # ======================
 # MAIN
 # ======================
-def main():
+def _load_sheet():
     service = get_sheets_service()
-    existing = read_sheet(service) or [HEADERS]
-
-    today_rows = []
-    run_date = None
+    sheet_id, dates = read_sheet_dates(service)
+    return service, sheet_id, dates
+
+
+def _stale_ranges(dates, run_date):
+    # [start, end) row indices of an earlier run for run_date, each with the
+    # blank separator rows right above it
+    ranges = []
+    blank_start = None
+    for i, date in enumerate(dates[1:], start=1):
+        if not date:
+            if blank_start is None:
+                blank_start = i
+            continue
+        if date == run_date:
+            start = i if blank_start is None else blank_start
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = i + 1
+            else:
+                ranges.append([start, i + 1])
+        blank_start = None
+    return ranges
 
-    for name, (lat, lon) in CONCELHOS.items():
-        forecast = _forecast_today(lat, lon)
-        run_date = forecast["date"]
 
-        today_rows.append([
+def main():
+    # set up the Sheets client and read the sheet while the forecast loads
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        sheet = ex.submit(_load_sheet)
+        forecasts = _forecast_today(list(CONCELHOS.values()))
+        service, sheet_id, dates = sheet.result()
+
+    today_rows = [
+        [
             forecast["date"],
             name,
             forecast["t_min_c"],
@@ -163,25 +268,25 @@ def main():
             forecast["wind_max_dir"],
             forecast["wind_second_max_kmh"],
             forecast["wind_second_max_dir"],
-        ])
-
-    # remove today's existing block
-    new_sheet = [HEADERS]
-    skip = False
-    for row in existing[1:]:
-        if row and row[0] == run_date:
-            skip = True
-            continue
-        if skip and row and row[0]:
-            skip = False
-        if not skip:
-            new_sheet.append(row)
+        ]
+        for name, forecast in zip(CONCELHOS, forecasts)
+    ]
+
+    run_date = today_rows[-1][0]
+
+    # only today's block travels: stale rows are deleted in place and the
+    # new block is appended, instead of rewriting the whole sheet
+    stale = _stale_ranges(dates, run_date)
+    kept = len(dates) - sum(end - start for start, end in stale)
 
-    if len(new_sheet) > 1:
-        new_sheet.append([""] * len(HEADERS))
-    new_sheet.extend(today_rows)
+    if not dates:
+        new_rows = [HEADERS] + today_rows
+    elif kept > 1:
+        new_rows = [[""] * len(HEADERS)] + today_rows
+    else:
+        new_rows = today_rows
 
-    write_sheet(service, new_sheet)
+    replace_rows(service, sheet_id, stale, new_rows)
     print("✅ Data appended with correct locations")
 
 